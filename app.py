@@ -1,103 +1,332 @@
-import os, re, json, asyncio, aiohttp, img2pdf, threading, time, uuid, io
-from PIL import Image
-from flask import Flask, render_template, request, send_file, jsonify
+import os, re, orjson, asyncio, aiohttp, threading, time, uuid, io, tempfile, sys, array, enum, atexit
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+from flask import Flask, render_template, request, send_file, jsonify, Response
+try:
+    import numpy as np
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+    TURBO = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    TURBO = None
+uvloop = None
+if sys.platform!="win32":
+    try: import uvloop
+    except ImportError: pass
 
 app = Flask(__name__)
 JOBS = {}
 JOBS_LOCK = threading.Lock()
+TOTAL, DONE, COMPRESSION_TOTAL, COMPRESSION_DONE = range(4)
+COUNTER_NAMES = ("total","done","compression_total","compression_done")
+
+class Status(enum.IntEnum):
+    STARTING = 0
+    DOWNLOADING = 1
+    COMPRESSING = 2
+    CREATING_PDF = 3
+    DONE = 4
+    FAILED = 5
+COMPRESS_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+# off by default: served JPEGs are embedded as-is, recompressing trades quality for size
+RECOMPRESS = os.environ.get("FLIPHTML5_RECOMPRESS","0")=="1"
+RETRY_STATUSES = (429,500,502,503,504)
+# EXIF orientation -> PDF /Rotate; mirrored orientations are re-encoded instead
+ROTATIONS = {0:0, 1:0, 3:180, 6:90, 8:270}
+PDF_TTL = int(os.environ.get("FLIPHTML5_PDF_TTL",3600))
+# connections per host across all jobs; also the default per-job download concurrency
+PER_HOST_LIMIT = 8
+CONCURRENCY = max(1,int(os.environ.get("FLIPHTML5_CONCURRENCY",PER_HOST_LIMIT)))
+BG_LOOP = None
+LOOP_LOCK = threading.Lock()
+SESSION = None
+
+def compress_image(image_data):
+    img=Image.open(io.BytesIO(image_data))
+    size=(int(img.width*0.6),int(img.height*0.6))
+    # lets libjpeg scale during DCT decode
+    img.draft("RGB", size)
+    img=img.resize(size, Image.Resampling.BILINEAR)
+    if TURBO:
+        if img.mode!="RGB": img=img.convert("RGB")
+        return TURBO.encode(np.asarray(img), quality=15, pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420)
+    buf=io.BytesIO()
+    img.save(buf,"JPEG",quality=15,optimize=True,progressive=True)
+    return buf.getvalue()
+
+def exif_orientation(tiff):
+    order="little" if tiff[:2]==b"II" else "big"
+    ifd=int.from_bytes(tiff[4:8],order)
+    count=int.from_bytes(tiff[ifd:ifd+2],order)
+    for e in range(ifd+2, min(ifd+2+12*count, len(tiff)-11), 12):
+        if int.from_bytes(tiff[e:e+2],order)==0x0112: return int.from_bytes(tiff[e+8:e+10],order)
+    return 1
+
+def jpeg_info(data):
+    if data[:2]!=b"\xff\xd8": return None
+    i=2; dpi=96; orientation=1
+    while i+4<=len(data):
+        if data[i]!=0xFF: return None
+        marker=data[i+1]
+        if marker==0xFF: i+=1; continue
+        if marker==0x01 or 0xD0<=marker<=0xD8: i+=2; continue
+        length=int.from_bytes(data[i+2:i+4],"big")
+        if marker==0xE0 and data[i+4:i+9]==b"JFIF\0":
+            units=data[i+11]; density=int.from_bytes(data[i+12:i+14],"big")
+            if density and units==1: dpi=density
+            elif density and units==2: dpi=density*2.54
+        if marker==0xE1 and data[i+4:i+10]==b"Exif\0\0":
+            orientation=exif_orientation(data[i+10:i+2+length])
+        if marker in (0xC0,0xC1,0xC2):
+            # 12-bit samples and mirrored pages go through to_jpeg instead
+            if data[i+4]!=8 or orientation not in ROTATIONS: return None
+            height=int.from_bytes(data[i+5:i+7],"big"); width=int.from_bytes(data[i+7:i+9],"big")
+            return width,height,data[i+9],dpi,ROTATIONS[orientation]
+        if 0xC3<=marker<=0xCF and marker not in (0xC4,0xC8,0xCC): return None
+        i+=2+length
+    return None
+
+def to_jpeg(image_data):
+    img=ImageOps.exif_transpose(Image.open(io.BytesIO(image_data)))
+    if img.mode not in ("RGB","L"): img=img.convert("RGB")
+    buf=io.BytesIO()
+    img.save(buf,"JPEG",quality=95)
+    return buf.getvalue()
+
+class PdfWriter:
+    # JPEGs are embedded verbatim as DCTDecode images, one per page
+    def __init__(self, f):
+        self.f=f; self.pos=0; self.offsets={}; self.kids=[]; self.num=3
+        self._put(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _put(self, data):
+        self.f.write(data); self.pos+=len(data)
+
+    def _obj(self, n, head, stream=None):
+        self.offsets[n]=self.pos
+        self._put(b"%d 0 obj\n%s" % (n, head))
+        if stream is not None: self._put(b"\nstream\n"); self._put(stream); self._put(b"\nendstream")
+        self._put(b"\nendobj\n")
+
+    def add_page(self, data):
+        info=jpeg_info(data)
+        if not info or info[2] not in (1,3):
+            data=to_jpeg(data); info=jpeg_info(data)
+        width,height,components,dpi,rotate=info
+        pw,ph=width*72/dpi,height*72/dpi
+        colorspace=b"/DeviceGray" if components==1 else b"/DeviceRGB"
+        num=self.num
+        self._obj(num, b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s /BitsPerComponent 8 /Filter /DCTDecode /Length %d >>" % (width,height,colorspace,len(data)), data)
+        content=b"q %.4f 0 0 %.4f 0 0 cm /Im0 Do Q" % (pw,ph)
+        self._obj(num+1, b"<< /Length %d >>" % len(content), content)
+        self._obj(num+2, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.4f %.4f] /Rotate %d /Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>" % (pw,ph,rotate,num,num+1))
+        self.kids.append(num+2); self.num+=3
+
+    def close(self):
+        num=self.num
+        self._obj(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % k for k in self.kids), len(self.kids)))
+        self._obj(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        xref=self.pos
+        self._put(b"xref\n0 %d\n0000000000 65535 f \n" % num)
+        for n in range(1,num): self._put(b"%010d 00000 n \n" % self.offsets[n])
+        self._put(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (num,xref))
+        return len(self.kids)
+
+def remove_pdf(pdf_path):
+    if not pdf_path: return
+    try: os.remove(pdf_path)
+    except OSError: pass
+
+# job fields are only written from BG_LOOP; JOBS_LOCK guards adding and removing jobs
+def update_job(job_id, **fields):
+    job=JOBS.get(job_id)
+    if job: job.update(fields)
+
+def bump(job_id, counter):
+    job=JOBS.get(job_id)
+    if job: job["counters"][counter]+=1
 
 async def fetch_json(session, url):
     async with session.get(url) as resp:
-        text = await resp.text(encoding="utf-8")
-        return json.loads(text.split('= ')[1][:-1])
+        raw = await resp.read()
+        return orjson.loads(raw[raw.index(b'= ')+2:].rstrip().rstrip(b';'))
 
-async def find_page_url(session, book_name, page_info):
+def page_urls(book_name, page_info):
     page_num_str = page_info["n"][0]
     page_index = page_info["p"] + 1
-    urls=[
+    return [
         f'https://online.fliphtml5.com/{book_name}/files/large/{page_num_str}',
         f'https://online.fliphtml5.com/{book_name}/files/page/{page_index}.jpg',
         f'https://online.fliphtml5.com/{book_name}{page_num_str[1:]}'
     ]
-    for url in urls:
+
+async def probe_url(session, url):
+    try:
+        async with session.head(url) as r: return r.status==200
+    except (aiohttp.ClientError, asyncio.TimeoutError): return False
+
+async def find_page_url(session, book_name, page_info, url_cache):
+    probe=None
+    if "probe" not in url_cache: probe=url_cache["probe"]=asyncio.get_running_loop().create_future()
+    try:
+        urls=page_urls(book_name, page_info)
+        found=await asyncio.gather(*[probe_url(session, url) for url in urls])
+        for i,ok in enumerate(found):
+            if ok: url_cache["template"]=i; return urls[i]
+        return None
+    finally:
+        if probe:
+            del url_cache["probe"]
+            if not probe.done(): probe.set_result(None)
+
+async def fetch_page(session, url, pause_event, retries=4):
+    for attempt in range(retries):
+        delay=0.5*2**attempt
+        # never pause mid-body, or a paused job would hold a pooled connection
+        await pause_event.wait()
         try:
-            async with session.head(url) as r:
-                if r.status==200: return url
-        except: continue
+            async with session.get(url) as r:
+                if r.status in RETRY_STATUSES:
+                    retry_after=r.headers.get("Retry-After","")
+                    if retry_after.isdigit(): delay=min(int(retry_after),30)
+                elif r.status!=200: return None
+                else:
+                    # slice assignment past the end still grows the buffer
+                    buffer=bytearray(int(r.headers.get("Content-Length") or 0))
+                    offset=0
+                    while True:
+                        chunk=await r.content.read(65536)
+                        if not chunk: break
+                        buffer[offset:offset+len(chunk)]=chunk
+                        offset+=len(chunk)
+                    del buffer[offset:]
+                    return buffer
+        except (aiohttp.ClientError, asyncio.TimeoutError): pass
+        if attempt<retries-1: await asyncio.sleep(delay)
     return None
 
-async def download_page(session, book_name, page_info, job_id):
+async def download_page(session, book_name, page_info, job_id, url_cache):
     pause_event=JOBS.get(job_id,{}).get("pause_event")
     if not pause_event: return None
-    url=await find_page_url(session, book_name, page_info)
-    if not url: return None
-    buffer=io.BytesIO()
     try:
-        async with session.get(url) as r:
-            if r.status==200:
-                while True:
-                    await pause_event.wait()
-                    chunk=await r.content.read(8192)
-                    if not chunk: break
-                    buffer.write(chunk)
-                with JOBS_LOCK:
-                    if job_id in JOBS: JOBS[job_id]["done"]+=1
-                return (page_info['p'], buffer.getvalue())
-            else: return None
+        data=None
+        template=url_cache.get("template")
+        if template is None and "probe" in url_cache:
+            await asyncio.shield(url_cache["probe"])
+            template=url_cache.get("template")
+        if template is not None:
+            data=await fetch_page(session, page_urls(book_name, page_info)[template], pause_event)
+        if data is None:
+            url=await find_page_url(session, book_name, page_info, url_cache)
+            if not url: return None
+            data=await fetch_page(session, url, pause_event)
+            if data is None: return None
+        bump(job_id, DONE)
+        return (page_info['p'], data)
     except: return None
 
 async def process_book(book_name, job_id):
     try:
-        with JOBS_LOCK: JOBS[job_id]["status"]="downloading"
+        update_job(job_id, status=Status.DOWNLOADING)
         config_file_url=f'https://online.fliphtml5.com/{book_name}/javascript/config.js'
-        async with aiohttp.ClientSession() as session:
-            try: config_dict=await fetch_json(session, config_file_url)
-            except: 
-                with JOBS_LOCK:
-                    if job_id in JOBS: JOBS[job_id]["status"]="failed"
-                return
-
-            pages=config_dict['fliphtml5_pages']
-            for i,page in enumerate(pages): page['p']=i
-            with JOBS_LOCK:
-                if job_id in JOBS:
-                    JOBS[job_id]["total"]=len(pages)
-                    JOBS[job_id]["book_title"]=re.sub(r'[<>:"/\\|?*]','_',config_dict['meta']['title'])
-                    JOBS[job_id]["compression_total"]=len(pages)
-                    JOBS[job_id]["compression_done"]=0
-
-            tasks=[download_page(session, book_name,page,job_id) for page in pages]
-            downloaded_pages=await asyncio.gather(*tasks)
-            downloaded_pages=sorted([p for p in downloaded_pages if p], key=lambda x:x[0])
-
-            with JOBS_LOCK:
-                if job_id not in JOBS: return
-                if not downloaded_pages: JOBS[job_id]["status"]="failed"; return
-                JOBS[job_id]["status"]="compressing"
-
-            compressed_images=[]
-            for _,img_bytes in downloaded_pages:
-                img=Image.open(io.BytesIO(img_bytes))
-                img=img.resize((int(img.width*0.6),int(img.height*0.6)), Image.Resampling.LANCZOS)
-                buf=io.BytesIO()
-                img.save(buf,"JPEG",quality=15)
-                compressed_images.append(buf.getvalue())
-                with JOBS_LOCK: JOBS[job_id]["compression_done"]+=1
-
-            with JOBS_LOCK: JOBS[job_id]["status"]="creating_pdf"
-            pdf_bytes=img2pdf.convert(compressed_images)
-            with JOBS_LOCK:
-                JOBS[job_id]["pdf_data"]=pdf_bytes
-                JOBS[job_id]["status"]="done"
-    except:
+        session=get_session()
+        try: config_dict=await fetch_json(session, config_file_url)
+        except: 
+            update_job(job_id, status=Status.FAILED)
+            return
+
+        pages=config_dict['fliphtml5_pages']
+        for i,page in enumerate(pages): page['p']=i
+        update_job(job_id, book_title=re.sub(r'[<>:"/\\|?*]','_',config_dict['meta']['title']))
+        job=JOBS.get(job_id)
+        if job: job["counters"][TOTAL]=job["counters"][COMPRESSION_TOTAL]=len(pages)
+
+        loop=asyncio.get_running_loop()
+        url_cache={}
+        pages_q=asyncio.Queue()
+        sem=asyncio.Semaphore(CONCURRENCY)
+        remaining=len(pages)
+        async def _bounded(page):
+            nonlocal remaining
+            try:
+                async with sem: result=await download_page(session, book_name, page, job_id, url_cache)
+            finally:
+                remaining-=1
+                if not remaining: update_job(job_id, status=Status.COMPRESSING)
+            if not result: pages_q.put_nowait((page['p'],None)); return
+            idx,img_bytes=result
+            if RECOMPRESS: img_bytes=await loop.run_in_executor(COMPRESS_POOL, compress_image, img_bytes)
+            bump(job_id, COMPRESSION_DONE)
+            pages_q.put_nowait((idx,img_bytes))
+
+        # writes pages in index order, buffering only those that arrive early
+        fd,pdf_path=tempfile.mkstemp(suffix=".pdf")
+        async def _write_pages():
+            pending={}; next_idx=0
+            with os.fdopen(fd,"wb") as f:
+                pdf=PdfWriter(f)
+                while next_idx<len(pages):
+                    idx,data=await pages_q.get()
+                    if idx is None: return 0
+                    pending[idx]=data
+                    while next_idx in pending:
+                        data=pending.pop(next_idx); next_idx+=1
+                        if data is not None: await loop.run_in_executor(COMPRESS_POOL, pdf.add_page, data)
+                return await loop.run_in_executor(COMPRESS_POOL, pdf.close)
+        writer=asyncio.ensure_future(_write_pages())
+        written=0
+        try:
+            downloads=asyncio.gather(*[_bounded(p) for p in pages])
+            # a dead writer would leave the rest of the book queued in memory
+            writer.add_done_callback(lambda w: w.cancelled() or w.exception() is None or downloads.cancel())
+            await downloads
+            update_job(job_id, status=Status.CREATING_PDF)
+            # shielded so a cancel never closes the file mid-write
+            if job_id in JOBS: written=await asyncio.shield(writer)
+        finally:
+            if not written:
+                pages_q.put_nowait((None,None))
+                await asyncio.wait([writer])
+                if not writer.cancelled(): writer.exception()
+                remove_pdf(pdf_path)
         with JOBS_LOCK:
-            if job_id in JOBS: JOBS[job_id]["status"]="failed"
+            if job_id not in JOBS: remove_pdf(pdf_path); return
+            if not written: JOBS[job_id]["status"]=Status.FAILED; return
+            JOBS[job_id]["pdf_path"]=pdf_path
+            JOBS[job_id]["status"]=Status.DONE
+    except:
+        update_job(job_id, status=Status.FAILED)
+
+def get_loop():
+    global BG_LOOP
+    with LOOP_LOCK:
+        if BG_LOOP is None:
+            BG_LOOP=uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+            threading.Thread(target=BG_LOOP.run_forever, daemon=True).start()
+    return BG_LOOP
+
+def get_session():
+    # only called on BG_LOOP, so check-and-create needs no lock
+    global SESSION
+    if SESSION is None or SESSION.closed:
+        connector=aiohttp.TCPConnector(limit=32, limit_per_host=PER_HOST_LIMIT, keepalive_timeout=30, ttl_dns_cache=300)
+        # no total timeout: it would count time spent waiting for a pooled connection
+        SESSION=aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(sock_connect=15, sock_read=30))
+    return SESSION
+
+def expire_job(job_id):
+    with JOBS_LOCK:
+        job=JOBS.pop(job_id,None)
+    if job: remove_pdf(job.get("pdf_path"))
+
+@atexit.register
+def remove_all_pdfs():
+    for job in list(JOBS.values()): remove_pdf(job.get("pdf_path"))
 
 def start_background_job(book_name, job_id):
-    loop=asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(process_book(book_name, job_id))
-    loop.close()
+    loop=get_loop()
+    future=asyncio.run_coroutine_threadsafe(process_book(book_name, job_id), loop)
+    future.add_done_callback(lambda _: loop.call_soon_threadsafe(loop.call_later, PDF_TTL, expire_job, job_id))
+    return future
 
 @app.route("/")
 def index(): return render_template("index.html")
@@ -107,13 +336,17 @@ def start():
     book_name=request.form.get("book_name")
     if not book_name: return jsonify({"status":"error","message":"Book ID required"}),400
     job_id=str(uuid.uuid4())
+    # binds to BG_LOOP lazily; only set/cleared via call_soon_threadsafe
+    pause_event=asyncio.Event(); pause_event.set()
+    with JOBS_LOCK:
+        JOBS[job_id]={ "book_name":book_name, "job_id":job_id, "status":Status.STARTING,
+            "counters":array.array("I",[0,0,0,0]),
+            "pdf_path":None, "book_title":"book", "paused":False, "recompress":RECOMPRESS,
+            "started":True, "start_time":time.time(), "pause_event":pause_event, "future":None }
+    future=start_background_job(book_name, job_id)
     with JOBS_LOCK:
-        pause_event=asyncio.Event(); pause_event.set()
-        JOBS[job_id]={ "book_name":book_name, "job_id":job_id, "status":"starting",
-            "total":0, "done":0, "compression_total":0, "compression_done":0,
-            "pdf_data":None, "book_title":"book", "paused":False,
-            "started":True, "start_time":time.time(), "pause_event":pause_event }
-    threading.Thread(target=start_background_job,args=(book_name,job_id)).start()
+        if job_id in JOBS: JOBS[job_id]["future"]=future
+        else: future.cancel()
     return jsonify({"status":"started","job_id":job_id})
 
 @app.route("/pause", methods=["POST"])
@@ -123,8 +356,8 @@ def pause():
     if not job_id or job_id not in JOBS: return jsonify({"status":"error","message":"Invalid job ID"}),404
     with JOBS_LOCK:
         job=JOBS[job_id]
-        if action=="pause": job["paused"]=True; job["pause_event"].clear(); status="paused"
-        elif action=="resume": job["paused"]=False; job["pause_event"].set(); status="downloading"
+        if action=="pause": job["paused"]=True; get_loop().call_soon_threadsafe(job["pause_event"].clear); status="paused"
+        elif action=="resume": job["paused"]=False; get_loop().call_soon_threadsafe(job["pause_event"].set); status="downloading"
         else: return jsonify({"status":"error","message":"Invalid action"}),400
     return jsonify({"status":status})
 
@@ -132,11 +365,13 @@ def pause():
 def get_progress():
     job_id=request.args.get("job_id")
     if not job_id: return jsonify({"status":"error","message":"Job ID required"}),400
-    with JOBS_LOCK:
-        job=JOBS.get(job_id)
-        if not job: return jsonify({"status":"not_found"}),404
-        state={k:v for k,v in job.items() if k not in ['pause_event','pdf_data']}
-    return jsonify(state)
+    # dict lookups and copies are atomic under the GIL
+    job=JOBS.get(job_id)
+    if not job: return jsonify({"status":"not_found"}),404
+    state={k:v for k,v in dict(job).items() if k not in ['pause_event','pdf_path','counters','future']}
+    state.update(zip(COUNTER_NAMES, list(job["counters"])))
+    state["status"]=state["status"].name.lower()
+    return Response(orjson.dumps(state), mimetype="application/json")
 
 @app.route("/download")
 def download():
@@ -145,10 +380,10 @@ def download():
     with JOBS_LOCK:
         job=JOBS.get(job_id)
         if not job: return "Job not found",404
-        pdf_data=job.get("pdf_data")
+        pdf_path=job.get("pdf_path")
         book_title=job.get("book_title","download")
-    if pdf_data:
-        return send_file(io.BytesIO(pdf_data), as_attachment=True, download_name=f"{book_title}.pdf", mimetype="application/pdf")
+    if pdf_path and os.path.exists(pdf_path):
+        return send_file(pdf_path, as_attachment=True, download_name=f"{book_title}.pdf", mimetype="application/pdf")
     return "PDF not ready yet.",404
 
 @app.route("/cancel", methods=["POST"])
@@ -157,7 +392,11 @@ def cancel():
     if not job_id: return jsonify({"status":"error","message":"Job ID required"}),400
     with JOBS_LOCK:
         job=JOBS.pop(job_id,None)
-    if job: return jsonify({"status":"cancelled","job_id":job_id})
+    if job:
+        if job["future"]: job["future"].cancel()
+        get_loop().call_soon_threadsafe(job["pause_event"].set)
+        remove_pdf(job.get("pdf_path"))
+        return jsonify({"status":"cancelled","job_id":job_id})
     return jsonify({"status":"error","message":"Job not found"}),404
 
 if __name__=="__main__":